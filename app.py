@@ -1,11 +1,25 @@
+import atexit
 import os
 import csv
+import hashlib
 import logging
-from flask import Flask, request, send_from_directory, render_template, jsonify
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from functools import lru_cache
+from html import escape as html_escape
+from flask import Flask, request, send_from_directory, render_template, make_response, jsonify
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-from amplitude import Amplitude, BaseEvent
-import tempfile
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
 
 # Load environment variables
 load_dotenv()
@@ -17,16 +31,58 @@ app.config['UPLOAD_EXTENSIONS'] = ['.csv']
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-# Initialize Amplitude client
+# Amplitude configuration
 AMPLITUDE_API_KEY = os.getenv('AMPLITUDE_API_KEY')
 if not AMPLITUDE_API_KEY:
-    logging.error("Amplitude API key not set.")
+    logger.error("Amplitude API key not set.")
     exit(1)
-amplitude_client = Amplitude(api_key=AMPLITUDE_API_KEY)
-
-# Global variable to store uploaded data
-uploaded_data = []
+AMPLITUDE_BATCH_URL = 'https://api2.amplitude.com/batch'
+# Amplitude rejects the whole batch if any user_id is shorter than this,
+# so uploads are validated against it
+AMPLITUDE_MIN_ID_LENGTH = 5
+
+# Events are posted in batches of up to 1000, several batches at a time,
+# by one worker pool shared by all requests over a keep-alive session with
+# a connection per worker. At most MAX_IN_FLIGHT_BATCHES per request are built
+# ahead of the network so a slow endpoint doesn't pull the whole upload
+# into memory.
+BATCH_SIZE = 1000
+SEND_WORKERS = 8
+MAX_IN_FLIGHT_BATCHES = 2 * SEND_WORKERS
+SEND_TIMEOUT_SECONDS = 30
+
+# Throttled (429) and server-error (5xx) responses, as well as connection
+# errors and timeouts, are retried with exponential backoff
+SEND_MAX_RETRIES = 3
+SEND_RETRY_BACKOFF_SECONDS = 1
+amplitude_session = requests.Session()
+amplitude_session.mount('https://', HTTPAdapter(pool_maxsize=SEND_WORKERS))
+send_executor = ThreadPoolExecutor(max_workers=SEND_WORKERS)
+
+# Required CSV columns, in order
+REQUIRED_COLUMNS = ['user_id', 'incident_name', 'short_description', 'datetime']
+
+# Number of rows shown in the upload preview
+PREVIEW_ROWS = 5
+
+# Validated uploads are spooled to disk, one file per upload token, next to
+# a file holding the SHA-256 of the upload's contents. The token is handed
+# to the browser in a cookie and read back by /send-events.
+# Spools are short-lived, so each process keeps them in its own private
+# (0700) directory, removed on exit.
+UPLOAD_DIR = tempfile.mkdtemp(prefix='incident-events-uploads-')
+atexit.register(shutil.rmtree, UPLOAD_DIR, ignore_errors=True)
+UPLOAD_COOKIE = 'upload_token'
+UPLOAD_MAX_AGE_SECONDS = 24 * 60 * 60
+DIGEST_SUFFIX = '.sha256'
+
+# Validated previews of recent uploads, keyed by the SHA-256 of the file
+# contents, so re-uploading the same CSV skips validation
+PREVIEW_CACHE_SIZE = 16
+preview_cache = OrderedDict()
+preview_cache_lock = threading.Lock()
 
 @app.route('/')
 def index():
@@ -38,98 +94,126 @@ def static_files(filename):
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    global uploaded_data
     if 'file' not in request.files:
-        logging.error("No file part in the request.")
+        logger.error("No file part in the request.")
         return "No file part.", 400
 
     file = request.files['file']
     if file.filename == '':
-        logging.error("No selected file.")
+        logger.error("No selected file.")
         return "No selected file.", 400
 
     filename = secure_filename(file.filename)
     if not filename.lower().endswith('.csv'):
-        logging.error(f"Invalid file type: {filename}")
+        logger.error("Invalid file type: %s", filename)
         return "Please upload a valid CSV file.", 400
 
+    remove_stale_uploads()
+    token = uuid.uuid4().hex
+    spool_path = upload_path(token)
     try:
-        # Save the file to a temporary location
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as tmp:
-            file.save(tmp.name)
-            temp_file_path = tmp.name
-
-        # Process the CSV file
-        data = process_csv(temp_file_path)
-        uploaded_data = data
+        # Spool the raw upload to disk, hashing it on the way
+        digest = hashlib.sha256()
+        spool_fd = os.open(spool_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(spool_fd, 'wb') as spool:
+            for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+                digest.update(chunk)
+                spool.write(chunk)
+        digest = digest.hexdigest()
+
+        with preview_cache_lock:
+            preview = preview_cache.get(digest)
+            if preview is not None:
+                preview_cache.move_to_end(digest)
+
+        if preview is None:
+            # Validate the spooled upload
+            with open(spool_path, 'r', newline='', encoding='utf-8') as csvfile:
+                preview = process_csv(csvfile)
+            with preview_cache_lock:
+                preview_cache[digest] = preview
+                while len(preview_cache) > PREVIEW_CACHE_SIZE:
+                    preview_cache.popitem(last=False)
+        preview_rows, total_rows = preview
+
+        # Keep the digest with the spool so /send-events can derive stable
+        # event insert_ids from the file contents
+        with open(spool_path + DIGEST_SUFFIX, 'w') as digest_file:
+            digest_file.write(digest)
+
+        # Replace any previous upload from this browser
+        remove_upload(request.cookies.get(UPLOAD_COOKIE))
 
         # Generate HTML response
-        html_response = generate_html_response(filename, data)
+        html_response = generate_html_response(filename, preview_rows, total_rows)
+
+        response = make_response(html_response, 200)
+        response.set_cookie(UPLOAD_COOKIE, token, httponly=True, samesite='Strict')
+        return response
 
-        return html_response, 200
+    except (ValueError, csv.Error) as e:
+        # Validation failures are the user's to fix, so tell them what is wrong
+        logger.error("Invalid CSV file: %s", e)
+        remove_upload(token)
+        return f"Invalid CSV file: {html_escape(str(e))}", 400
 
     except Exception as e:
-        logging.error(f"Error processing file: {e}")
+        logger.error("Error processing file: %s", e)
+        remove_upload(token)
         return "Failed to process the uploaded file. Please check your CSV file and follow the required column order from the sample data.", 500
-    finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-
-def process_csv(filename):
-    REQUIRED_COLUMNS = ['user_id', 'incident_name', 'short_description', 'datetime']
-    
-    with open(filename, 'r', newline='', encoding='utf-8') as csvfile:
-        reader = csv.reader(csvfile)
-        records = list(reader)
-        
-        if not records or len(records) < 2:
-            raise ValueError("CSV file is empty or contains only headers")
-            
-        headers = records[0]
-        
-        # Validate column order
-        if headers != REQUIRED_COLUMNS:
-            raise ValueError(f"CSV columns must be in order: {', '.join(REQUIRED_COLUMNS)}")
-        
-        # Validate data rows
-        for row_num, row in enumerate(records[1:], start=2):
-            if len(row) != len(headers):
-                raise ValueError(f"Row {row_num} has incorrect number of columns")
-                
-            # Check for empty values in required fields
-            if not row[0].strip():  # user_id
-                raise ValueError(f"Row {row_num}: user_id cannot be empty")
-            if not row[1].strip():  # incident_name
-                raise ValueError(f"Row {row_num}: incident_name cannot be empty")
-            if not row[3].strip():  # datetime
-                raise ValueError(f"Row {row_num}: datetime cannot be empty")
-                
-    return records
 
-def generate_html_response(filename, data):
-    if not data:
-        return "<p>No data found in the CSV file.</p>"
+def process_csv(csvfile):
+    """Validate CSV rows as they are read from csvfile.
 
-    headers = data[0]
-    rows = data[1:]
-    total_rows = len(rows)
-
-    # Limit preview to first 5 rows
-    preview_rows = rows[:5]
+    Returns the first PREVIEW_ROWS data rows and the total number of data rows.
+    """
+    reader = csv.reader(csvfile)
+
+    # Validate column order
+    headers = next(reader, None)
+    if headers is None:
+        raise ValueError("CSV file is empty or contains only headers")
+    if headers != REQUIRED_COLUMNS:
+        raise ValueError(f"CSV columns must be in order: {', '.join(REQUIRED_COLUMNS)}")
+
+    preview_rows = []
+    total_rows = 0
+
+    # Validate data rows as they are read, in the same scan that fills the preview
+    num_columns = len(REQUIRED_COLUMNS)
+    for row_num, row in enumerate(reader, start=2):
+        if len(row) != num_columns:
+            raise ValueError(f"Row {row_num} has incorrect number of columns")
+        user_id, incident_name, _, timestamp_str = row
+
+        # Check for empty values in required fields. isspace() stops at the
+        # first non-space character and, unlike strip(), allocates nothing.
+        if not user_id or user_id.isspace():
+            raise ValueError(f"Row {row_num}: user_id cannot be empty")
+        if len(user_id) < AMPLITUDE_MIN_ID_LENGTH:
+            raise ValueError(f"Row {row_num}: user_id must be at least {AMPLITUDE_MIN_ID_LENGTH} characters")
+        if not incident_name or incident_name.isspace():
+            raise ValueError(f"Row {row_num}: incident_name cannot be empty")
+        if not timestamp_str or timestamp_str.isspace():
+            raise ValueError(f"Row {row_num}: datetime cannot be empty")
+
+        if total_rows < PREVIEW_ROWS:
+            preview_rows.append(row)
+        total_rows += 1
+
+    if not total_rows:
+        raise ValueError("CSV file is empty or contains only headers")
+                
+    return preview_rows, total_rows
 
+def generate_html_response(filename, preview_rows, total_rows):
     # Generate HTML table
-    table_html = "<table>"
-    table_html += "<tr>"
-    for header in headers:
-        table_html += f"<th>{html_escape(header)}</th>"
-    table_html += "</tr>"
-
-    for row in preview_rows:
-        table_html += "<tr>"
-        for cell in row:
-            table_html += f"<td>{html_escape(cell)}</td>"
-        table_html += "</tr>"
-    table_html += "</table>"
+    header_html = "".join(f"<th>{html_escape(header)}</th>" for header in REQUIRED_COLUMNS)
+    rows_html = "".join(
+        "<tr>" + "".join(f"<td>{html_escape(cell)}</td>" for cell in row) + "</tr>"
+        for row in preview_rows
+    )
+    table_html = f"<table><tr>{header_html}</tr>{rows_html}</table>"
 
     html = f"""
     <div id="preview-container">
@@ -142,115 +226,212 @@ def generate_html_response(filename, data):
     """
     return html
 
-def html_escape(text):
-    """Escape HTML special characters in text."""
-    import html
-    return html.escape(text)
+def upload_path(token):
+    """Return the spool path for an upload token, or None if it is malformed."""
+    try:
+        token = uuid.UUID(token).hex
+    except (TypeError, ValueError):
+        return None
+    return os.path.join(UPLOAD_DIR, f"{token}.csv")
+
+def remove_upload(token):
+    """Delete the spooled upload for token and its digest, if any."""
+    path = upload_path(token)
+    if not path:
+        return
+    for upload_file in (path, path + DIGEST_SUFFIX):
+        if os.path.exists(upload_file):
+            os.remove(upload_file)
+
+def remove_stale_uploads():
+    """Delete spooled uploads older than UPLOAD_MAX_AGE_SECONDS.
+
+    This is housekeeping only, so errors are logged rather than raised.
+    """
+    cutoff = time.time() - UPLOAD_MAX_AGE_SECONDS
+    try:
+        with os.scandir(UPLOAD_DIR) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.warning("Could not remove stale upload %s: %s", entry.path, e)
+    except OSError as e:
+        logger.warning("Could not sweep upload directory %s: %s", UPLOAD_DIR, e)
 
 @app.route('/cancel', methods=['POST'])
 def cancel_upload():
-    global uploaded_data
-    uploaded_data = []
-    return "Upload cancelled.", 200
+    remove_upload(request.cookies.get(UPLOAD_COOKIE))
+    response = make_response("Upload cancelled.", 200)
+    response.delete_cookie(UPLOAD_COOKIE)
+    return response
+
+# Supported timestamp layouts. The layout is picked up front by looking
+# for a '/', so each string is matched against a single pattern. Like
+# strptime, a space matches any run of whitespace and the zone name is
+# case-insensitive.
+US_TIMESTAMP_RE = re.compile(  # "03/15/2024 13:30" (original format)
+    r'(\d{1,2})/(\d{1,2})/(\d{4})\s+(\d{1,2}):(\d{1,2})'
+)
+UTC_TIMESTAMP_RE = re.compile(  # "2024-10-03 13:59:39.598 UTC" (or GMT), with or without milliseconds
+    r'(\d{4})-(\d{1,2})-(\d{1,2})\s+(\d{1,2}):(\d{1,2}):(\d{1,2})(?:\.(\d{1,6}))?\s+(?:UTC|GMT)',
+    re.IGNORECASE
+)
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(timestamp_str):
+    """Parse a timestamp string into Unix milliseconds.
+
+    Incident CSVs often repeat the same timestamp across many rows, so
+    results are cached by string.
+    """
+    if '/' in timestamp_str:
+        match = US_TIMESTAMP_RE.fullmatch(timestamp_str)
+        if match is None:
+            raise ValueError(f"Could not parse timestamp: {timestamp_str}")
+        month, day, year, hour, minute = map(int, match.groups())
+        dt = datetime(year, month, day, hour, minute, tzinfo=timezone.utc)
+    else:
+        match = UTC_TIMESTAMP_RE.fullmatch(timestamp_str)
+        if match is None:
+            raise ValueError(f"Could not parse timestamp: {timestamp_str}")
+        *fields, fraction = match.groups()
+        microsecond = int((fraction or '0').ljust(6, '0'))
+        dt = datetime(*map(int, fields), microsecond, tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def send_batch(events):
+    """Post a batch of event bodies to the Amplitude batch endpoint.
+
+    Retries up to SEND_MAX_RETRIES times on throttling, server errors and
+    connection failures, then raises requests.RequestException.
+    """
+    body = orjson.dumps({"api_key": AMPLITUDE_API_KEY, "events": events})
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        retries_left = attempt < SEND_MAX_RETRIES
+        try:
+            response = amplitude_session.post(
+                AMPLITUDE_BATCH_URL,
+                data=body,
+                headers={"Content-Type": "application/json"},
+                timeout=SEND_TIMEOUT_SECONDS
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not retries_left:
+                raise
+            logger.warning("Batch of %d events failed (%s), retrying", len(events), e)
+        else:
+            retryable = response.status_code == 429 or response.status_code >= 500
+            if not (retryable and retries_left):
+                response.raise_for_status()
+                return
+            logger.warning("Batch of %d events got HTTP %d, retrying", len(events), response.status_code)
+        time.sleep(SEND_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+def collect_batches(done, in_flight):
+    """Remove finished futures from in_flight.
+
+    Returns the number of events sent and failed by those batches.
+    """
+    sent = failed = 0
+    for future in done:
+        batch_size = in_flight.pop(future)
+        try:
+            future.result()
+            sent += batch_size
+        except Exception as e:
+            failed += batch_size
+            logger.error("Failed to send batch of %d events: %s", batch_size, e)
+    return sent, failed
 
 @app.route('/send-events', methods=['POST'])
 def send_events():
-    global uploaded_data
-    if not uploaded_data or len(uploaded_data) < 2:
+    token = request.cookies.get(UPLOAD_COOKIE)
+    path = upload_path(token)
+    if not path or not os.path.exists(path) or not os.path.exists(path + DIGEST_SUFFIX):
         return "No data to send.", 400
 
-    headers = uploaded_data[0]
-    user_id_idx = headers.index('user_id')
-    incident_name_idx = headers.index('incident_name')
-    description_idx = headers.index('short_description')
-    datetime_idx = headers.index('datetime')
-
     successful_events = 0
     failed_events = 0
-    total_events = len(uploaded_data[1:])
-
-    logging.info(f"Starting to process {total_events} events...")
+    in_flight = {}  # Future -> number of events in its batch
 
-    for record in uploaded_data[1:]:
-        try:
-            user_id = record[user_id_idx]
-            incident_name = record[incident_name_idx]
-            description = record[description_idx]
-            timestamp_str = record[datetime_idx]
-
-            # Parse timestamp with multiple format support
-            from datetime import datetime
-            import pytz
-
-            # Try different timestamp formats
-            timestamp_formats = [
-                "%m/%d/%Y %H:%M",           # Original format: "03/15/2024 13:30"
-                "%Y-%m-%d %H:%M:%S.%f %Z",  # New format: "2024-10-03 13:59:39.598 UTC"
-                "%Y-%m-%d %H:%M:%S %Z"      # Alternative without milliseconds
-            ]
-
-            dt = None
-            for fmt in timestamp_formats:
-                try:
-                    if 'UTC' in timestamp_str:
-                        dt = datetime.strptime(timestamp_str, fmt)
-                        if fmt.endswith('%Z'):
-                            dt = dt.replace(tzinfo=pytz.UTC)
-                    else:
-                        dt = datetime.strptime(timestamp_str, fmt)
-                        dt = pytz.utc.localize(dt)
-                    break
-                except ValueError:
-                    continue
+    # The content digest and row number identify each event, so Amplitude
+    # drops events it already accepted when the same file is sent again,
+    # whether from this upload or from uploading it again
+    # (128 bits of the digest keep insert_ids short and still unique)
+    with open(path + DIGEST_SUFFIX) as digest_file:
+        upload_id = digest_file.read()[:32]
 
-            if dt is None:
-                raise ValueError(f"Could not parse timestamp: {timestamp_str}")
-
-            unix_timestamp = int(dt.timestamp() * 1000)
-
-            # Create and send event to Amplitude
-            event = BaseEvent(
-                user_id=user_id,
-                event_type="Incident",
-                event_properties={
-                    "name": incident_name,
-                    "description": description,
-                    "original_timestamp": timestamp_str
-                },
-                time=unix_timestamp
-            )
-            amplitude_client.track(event)
-            successful_events += 1
-            logging.info(
-                f"Event {successful_events}/{total_events} sent successfully:\n"
-                f"  User ID: {user_id}\n"
-                f"  Incident: {incident_name}\n"
-                f"  Time: {timestamp_str}\n"
-                f"  Description: {description[:100]}{'...' if len(description) > 100 else ''}"
-            )
+    logger.info("Starting to process events from %s...", os.path.basename(path))
 
-        except Exception as e:
-            failed_events += 1
-            logging.error(
-                f"Failed to send event {successful_events + failed_events}/{total_events}:\n"
-                f"  User ID: {user_id}\n"
-                f"  Error: {str(e)}"
-            )
-            continue
-
-    amplitude_client.flush()
+    # Stream the validated rows back from disk, handing each full batch
+    # to the pool while the next one is being built
+    with open(path, 'r', newline='', encoding='utf-8') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)  # Skip headers
+
+        batch = []
+        for event_num, (user_id, incident_name, description, timestamp_str) in enumerate(reader, start=1):
+            try:
+                unix_timestamp = parse_timestamp(timestamp_str)
+
+                # Create the event for Amplitude
+                batch.append({
+                    "user_id": user_id,
+                    "event_type": "Incident",
+                    "event_properties": {
+                        "name": incident_name,
+                        "description": description,
+                        "original_timestamp": timestamp_str
+                    },
+                    "time": unix_timestamp,
+                    "insert_id": f"{upload_id}-{event_num}"
+                })
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Event %d queued: user=%s incident=%s time=%s",
+                                event_num, user_id, incident_name, timestamp_str)
+                    logger.debug("Event %d description: %.100s", event_num, description)
+
+            except Exception as e:
+                failed_events += 1
+                logger.error("Failed to send event %d: user=%s error=%s", event_num, user_id, e)
+                continue
+
+            if len(batch) == BATCH_SIZE:
+                # Wait for a batch to finish before building more than
+                # MAX_IN_FLIGHT_BATCHES ahead of the network
+                if len(in_flight) >= MAX_IN_FLIGHT_BATCHES:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    sent, failed = collect_batches(done, in_flight)
+                    successful_events += sent
+                    failed_events += failed
+                in_flight[send_executor.submit(send_batch, batch)] = len(batch)
+                batch = []
+
+        if batch:
+            in_flight[send_executor.submit(send_batch, batch)] = len(batch)
+
+        sent, failed = collect_batches(list(in_flight), in_flight)
+        successful_events += sent
+        failed_events += failed
+
+    # Once everything is sent the spooled data is no longer needed. After a
+    # failure it is kept so the upload can be sent again.
+    if not failed_events:
+        remove_upload(token)
     
-    result_message = (
-        f"Processing complete. "
-        f"Successfully sent {successful_events} events, "
-        f"Failed to send {failed_events} events."
+    logger.info(
+        "Processing complete. Successfully sent %d events, Failed to send %d events.",
+        successful_events, failed_events
     )
-    logging.info(result_message)
     
     if failed_events > 0 and successful_events > 0:
-        return f"Partial success. Sent {successful_events} events, {failed_events} events failed to send.", 207  # Multi-Status
+        return f"Partial success. Sent {successful_events} events, {failed_events} events failed to send. Sending again retries them without duplicating events already sent.", 207  # Multi-Status
     elif failed_events > 0:
-        return f"Failed to send {failed_events} events.", 207  # Multi-Status
+        return f"Failed to send {failed_events} events. Sending again retries them without duplicating events already sent.", 207  # Multi-Status
     return f"Successfully sent {successful_events} events.", 200
 
 if __name__ == '__main__':